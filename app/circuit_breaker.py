@@ -0,0 +1,113 @@
+import time
+import threading
+from collections import deque
+
+WINDOW = 50
+# 4xx messages that mean semantic ranking itself is unavailable (tier, quota, throttling) rather than a bad request
+SEMANTIC_UNAVAILABLE = ("quota", "not enabled", "not available", "throttl")
+
+
+def is_service_failure(mode: str, status_code: int | None, message: str) -> bool:
+    """Whether an error says the mode is down for everyone, as opposed to this request being bad"""
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return True
+    return mode == "semantic" and any(m in message.lower() for m in SEMANTIC_UNAVAILABLE)
+
+
+class ModeStats:
+    def __init__(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.probing = False
+        self.calls = 0
+        self.errors = 0
+        self.latency_ms = None
+        self.recent = deque(maxlen=WINDOW)
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "calls": self.calls,
+            "errors": self.errors,
+            "recent_error_rate": round(self.recent.count(False) / len(self.recent), 3) if self.recent else 0.0,
+            "avg_latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "retry_in_s": round(max(0.0, self.opened_at + self.cooldown - time.monotonic()), 1) if self.state == "open" else None,
+        }
+
+
+class CircuitBreaker:
+    """Per-mode circuit breaker for the search fallback chain.
+
+    Health is tracked for every mode, but only `skippable` modes have a
+    circuit: after `failure_threshold` consecutive failures such a mode is
+    opened and requests route straight past it. Once its cooldown has elapsed
+    a single background probe is allowed; success closes the circuit, failure
+    reopens it with a doubled cooldown (capped at `max_cooldown`).
+    """
+
+    def __init__(self, modes: list[str], skippable: tuple[str, ...] = (), failure_threshold: int = 3, cooldown: float = 30.0, max_cooldown: float = 300.0):
+        self.skippable = set(skippable)
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.modes = {m: ModeStats() for m in modes}
+        self.lock = threading.Lock()
+
+    def allow(self, mode: str) -> bool:
+        with self.lock:
+            return self.modes[mode].state == "closed"
+
+    def record_success(self, mode: str, latency: float):
+        with self.lock:
+            s = self.modes[mode]
+            s.calls += 1
+            s.recent.append(True)
+            ms = latency * 1000
+            s.latency_ms = ms if s.latency_ms is None else 0.8 * s.latency_ms + 0.2 * ms
+            s.consecutive_failures = 0
+            if s.state != "closed":
+                print(f"[INFO] Search mode '{mode}' recovered, closing circuit")
+            s.state, s.cooldown = "closed", 0.0
+
+    def record_failure(self, mode: str):
+        with self.lock:
+            s = self.modes[mode]
+            s.calls += 1
+            s.errors += 1
+            s.recent.append(False)
+            s.consecutive_failures += 1
+            if mode not in self.skippable:
+                return
+            if s.state == "half_open" or (s.state == "closed" and s.consecutive_failures >= self.failure_threshold):
+                s.cooldown = min(self.max_cooldown, s.cooldown * 2) if s.cooldown else self.base_cooldown
+                s.state, s.opened_at = "open", time.monotonic()
+                print(f"[WARN] Search mode '{mode}' failing, opening circuit for {s.cooldown:.0f}s")
+
+    def maybe_probe(self, mode: str, probe):
+        """Start a background probe of an open mode once its cooldown has elapsed"""
+        with self.lock:
+            s = self.modes[mode]
+            if s.state != "open" or s.probing or time.monotonic() - s.opened_at < s.cooldown:
+                return
+            s.state, s.probing = "half_open", True
+
+        def run():
+            start = time.perf_counter()
+            try:
+                probe()
+            except Exception:
+                self.record_failure(mode)
+            else:
+                self.record_success(mode, time.perf_counter() - start)
+            finally:
+                with self.lock:
+                    s.probing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {m: s.to_dict() for m, s in self.modes.items()}
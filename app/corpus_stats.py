@@ -0,0 +1,101 @@
+import gzip
+import json
+import threading
+from datetime import datetime, timezone
+
+STATS_BLOB = "corpus_stats.json.gz"
+
+
+def _none_last(item):
+    # Chunks indexed without year/month facet as null; keep them sortable next to the ints
+    return (item[0] is None, item[0] or 0)
+
+
+class CorpusStats:
+    """Incrementally maintained chunk statistics for the search index.
+
+    Counts are kept per pdf_id, so re-indexing an issue replaces its entry
+    instead of double counting. Aggregates are rebuilt on every update so
+    reading a snapshot costs nothing.
+    """
+
+    def __init__(self):
+        self.pdfs = {}
+        self.sample = None
+        self.snapshot = self._build_snapshot()
+        self.lock = threading.Lock()
+
+    def record_issue(self, pdf_id: str, year: int, month: int, chunks: list[dict]):
+        with self.lock:
+            self.pdfs[pdf_id] = {
+                "year": year,
+                "month": month,
+                "chunks": len(chunks),
+                "chars": sum(len(c.get("text") or "") for c in chunks),
+            }
+            if chunks:
+                c = chunks[0]
+                self.sample = {k: c.get(k) for k in ("chunk_id", "pdf_id", "year", "month", "page_start")}
+            self.snapshot = self._build_snapshot()
+
+    def replace_all(self, pdfs: dict, sample: dict | None):
+        with self.lock:
+            self.pdfs = pdfs
+            self.sample = sample
+            self.snapshot = self._build_snapshot()
+
+    def _build_snapshot(self) -> dict:
+        total_chunks = sum(p["chunks"] for p in self.pdfs.values())
+        total_chars = sum(p["chars"] for p in self.pdfs.values())
+        by_year, by_month, by_year_month = {}, {}, {}
+        for p in self.pdfs.values():
+            by_year[p["year"]] = by_year.get(p["year"], 0) + p["chunks"]
+            by_month[p["month"]] = by_month.get(p["month"], 0) + p["chunks"]
+            ym = f"{p['year']:04d}-{p['month']:02d}" if p["year"] is not None and p["month"] is not None else "unknown"
+            by_year_month[ym] = by_year_month.get(ym, 0) + p["chunks"]
+        return {
+            "total_docs": total_chunks,
+            "total_pdfs": len(self.pdfs),
+            "avg_chunk_chars": round(total_chars / total_chunks, 1) if total_chunks else 0.0,
+            # Same shape as the search facets this endpoint used to return
+            "facets": {
+                "year": [{"value": y, "count": n} for y, n in sorted(by_year.items(), key=_none_last)],
+                "month": [{"value": m, "count": n} for m, n in sorted(by_month.items(), key=_none_last)],
+            },
+            "by_year_month": dict(sorted(by_year_month.items())),
+            "by_pdf_id": {pid: p["chunks"] for pid, p in sorted(self.pdfs.items())},
+            "sample": [self.sample] if self.sample else [],
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def to_dict(self) -> dict:
+        # Copy under the lock: other pipeline workers keep calling record_issue while this is serialized
+        with self.lock:
+            return {
+                "pdfs": {pid: dict(p) for pid, p in self.pdfs.items()},
+                "sample": dict(self.sample) if self.sample else None,
+                "snapshot": self.snapshot,
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CorpusStats":
+        stats = cls()
+        stats.pdfs = data.get("pdfs", {})
+        stats.sample = data.get("sample")
+        stats.snapshot = data.get("snapshot") or stats._build_snapshot()
+        return stats
+
+
+def dump_stats(stats: CorpusStats) -> bytes:
+    return gzip.compress(json.dumps(stats.to_dict()).encode("utf-8"))
+
+
+def parse_stats(raw: bytes) -> CorpusStats:
+    return CorpusStats.from_dict(json.loads(gzip.decompress(raw)))
+
+
+def load_stats(container) -> CorpusStats:
+    blob = container.get_blob_client(STATS_BLOB)
+    if not blob.exists():
+        return CorpusStats()
+    return parse_stats(blob.download_blob().readall())
@@ -0,0 +1,54 @@
+import json
+import zlib
+import base64
+import struct
+
+FIELDS = ("query", "vec", "year", "month", "skip", "k", "mode")
+# Azure AI Search rejects $skip above this
+MAX_SKIP = 100000
+
+
+def as_float32(vec: list[float]) -> list[float]:
+    # Round to the precision carried in cursors so the first page and later pages rank identically
+    return list(struct.unpack(f"<{len(vec)}f", struct.pack(f"<{len(vec)}f", *vec)))
+
+
+def encode_cursor(state: dict) -> str:
+    """Opaque continuation token; the query vector travels as packed float32 so pages never re-embed"""
+    state = {k: state[k] for k in FIELDS}
+    vec = state["vec"]
+    state["vec"] = base64.b64encode(struct.pack(f"<{len(vec)}f", *vec)).decode("ascii")
+    raw = zlib.compress(json.dumps(state).encode("utf-8"))
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _is_int(v) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def decode_cursor(token: str, modes: list[str], dim: int) -> dict:
+    """Decode and validate a cursor, raising ValueError for anything malformed or out of range.
+
+    The token is not signed. Only plain values travel in it (year/month
+    rather than a filter string) and the server rebuilds the query itself,
+    so an edited token can ask for nothing a fresh request couldn't.
+    """
+    try:
+        state = json.loads(zlib.decompress(base64.urlsafe_b64decode(token.encode("ascii"))))
+        packed = base64.b64decode(state["vec"], validate=True)
+        state["vec"] = list(struct.unpack(f"<{len(packed) // 4}f", packed))
+        state = {k: state[k] for k in FIELDS}
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+    valid = (
+        isinstance(state["query"], str)
+        and len(state["vec"]) == dim
+        and all(v is None or _is_int(v) for v in (state["year"], state["month"]))
+        and _is_int(state["skip"]) and 0 <= state["skip"] <= MAX_SKIP
+        and _is_int(state["k"]) and state["k"] > 0
+        and state["mode"] in modes
+    )
+    if not valid:
+        raise ValueError("Invalid cursor")
+    return state
@@ -0,0 +1,152 @@
+import re
+import base64
+import struct
+import hashlib
+import random
+import threading
+
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+_rng = random.Random(1)
+PERMUTATIONS = [(_rng.randint(1, MERSENNE_PRIME - 1), _rng.randint(0, MERSENNE_PRIME - 1)) for _ in range(NUM_PERM)]
+
+
+def shingles(text: str) -> set[int]:
+    """Hashed word n-grams of the normalized text"""
+    words = re.sub(r"\W+", " ", text.lower()).split()
+    if len(words) < SHINGLE_SIZE:
+        grams = [" ".join(words)]
+    else:
+        grams = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    return {int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=4).digest(), "little") for g in grams}
+
+
+def minhash(text: str) -> list[int]:
+    hashes = shingles(text)
+    return [min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes) for a, b in PERMUTATIONS]
+
+
+def similarity(sig1: list[int], sig2: list[int]) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(x == y for x, y in zip(sig1, sig2)) / len(sig1)
+
+
+class DedupIndex:
+    """Persistent MinHash/LSH index of canonical chunks across the corpus.
+
+    Only canonical (first-seen) chunks are indexed. `sources` records, per
+    canonical chunk, where its near-duplicates were found ("pdf_id#p<page>").
+    """
+
+    def __init__(self, threshold: float = 0.8):
+        self.threshold = threshold
+        self.signatures = {}
+        self.sources = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _band_keys(self, sig: list[int]):
+        rows = NUM_PERM // BANDS
+        for b in range(BANDS):
+            yield f"{b}:" + ",".join(map(str, sig[b * rows:(b + 1) * rows]))
+
+    def query(self, chunk_id: str, sig: list[int]) -> str | None:
+        """Return the best matching canonical chunk id other than `chunk_id`, if any"""
+        best, best_sim = None, self.threshold
+        candidates = set()
+        for key in self._band_keys(sig):
+            candidates.update(self.buckets.get(key, ()))
+        candidates.discard(chunk_id)
+        for cid in candidates:
+            sim = similarity(sig, self.signatures[cid])
+            if sim >= best_sim:
+                best, best_sim = cid, sim
+        return best
+
+    def add(self, chunk_id: str, sig: list[int]):
+        if chunk_id in self.signatures:
+            return
+        self.signatures[chunk_id] = sig
+        for key in self._band_keys(sig):
+            self.buckets.setdefault(key, []).append(chunk_id)
+
+    def add_source(self, canonical_id: str, source: str) -> list[str]:
+        srcs = self.sources.setdefault(canonical_id, [])
+        if source not in srcs:
+            srcs.append(source)
+        return srcs
+
+    def sources_for(self, canonical_ids) -> dict:
+        with self.lock:
+            return {cid: list(self.sources.get(cid, [])) for cid in canonical_ids}
+
+    def commit(self, signatures: dict, duplicates: list):
+        """Register canonical signatures and provenance once their chunks are safely indexed"""
+        with self.lock:
+            for cid, sig in signatures.items():
+                self.add(cid, sig)
+            for c, canonical in duplicates:
+                self.add_source(canonical, source_of(c))
+
+    def merge(self, other: "DedupIndex"):
+        """Fold in signatures and provenance written by another instance"""
+        with self.lock:
+            for cid, sig in other.signatures.items():
+                self.add(cid, sig)
+            for canonical, srcs in other.sources.items():
+                for src in srcs:
+                    self.add_source(canonical, src)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "threshold": self.threshold,
+                "signatures": {cid: base64.b64encode(struct.pack(f"<{NUM_PERM}I", *sig)).decode("ascii") for cid, sig in self.signatures.items()},
+                "sources": {cid: list(srcs) for cid, srcs in self.sources.items()},
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict, threshold: float | None = None) -> "DedupIndex":
+        idx = cls(threshold if threshold is not None else data.get("threshold", 0.8))
+        for cid, packed in data.get("signatures", {}).items():
+            idx.add(cid, list(struct.unpack(f"<{NUM_PERM}I", base64.b64decode(packed))))
+        idx.sources = data.get("sources", {})
+        return idx
+
+
+def source_of(chunk: dict) -> str:
+    return f"{chunk['pdf_id']}#p{chunk['page_start']}"
+
+
+def dedup_chunks(chunks: list[dict], index: DedupIndex):
+    """Split chunks into (unique, duplicates, signatures).
+
+    `duplicates` is a list of (chunk, canonical_id) and `signatures` maps each
+    unique chunk id to its MinHash. Nothing is written to `index`: call
+    `index.commit(signatures, duplicates)` once the unique chunks are indexed,
+    so other workers never match a canonical that isn't searchable yet.
+    Repeats within the batch are matched against a scratch index.
+
+    A chunk that is already a registered canonical stays canonical: issues
+    indexed concurrently can each register a copy of the same masthead,
+    and on reprocessing those copies must not start pointing at each other.
+    """
+    batch = DedupIndex(index.threshold)
+    unique, duplicates = [], []
+    for c in chunks:
+        sig = minhash(c["text"])
+        with index.lock:
+            registered = c["chunk_id"] in index.signatures
+            canonical = None if registered else index.query(c["chunk_id"], sig)
+        if canonical is None and not registered:
+            canonical = batch.query(c["chunk_id"], sig)
+        if canonical is None:
+            batch.add(c["chunk_id"], sig)
+            unique.append(c)
+        else:
+            duplicates.append((c, canonical))
+    return unique, duplicates, batch.signatures
@@ -1,4 +1,5 @@
 import os
+import math
 import time
 import requests
 from typing import List
@@ -19,6 +20,8 @@ EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL", "text-embedding-3-large")
 BATCH_SIZE = 16
 MAX_RETRIES = 5
 BACKOFF_FACTOR = 2  
+# Dimensions of the Matryoshka projection used for two-stage retrieval; unset disables it
+COARSE_DIM = int(os.getenv("AZURE_SEARCH_COARSE_DIM", 0)) or None
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
     embeddings = []
@@ -56,6 +59,24 @@ def embed_texts(texts: List[str]) -> List[List[float]]:
 
     return embeddings
 
+def embed_query(q: str) -> list[float]:
+    if not q.strip():
+        return []
+    url = f"{AOAI_ENDPOINT}/openai/deployments/{EMBED_MODEL}/embeddings?api-version=2024-06-01"
+    headers = {"api-key": AOAI_KEY, "Content-Type": "application/json"}
+    resp = requests.post(url, headers=headers, json={"input": q})
+    resp.raise_for_status()
+    data = resp.json()
+    if "data" not in data or not data["data"]:
+        raise ValueError("Embedding API returned empty response.")
+    return data["data"][0]["embedding"]
+
+def truncate_embedding(vec: list[float], dim: int) -> list[float]:
+    # Matryoshka truncation: keep the leading dims and renormalize to unit length
+    head = vec[:dim]
+    norm = math.sqrt(sum(x * x for x in head))
+    return [x / norm for x in head] if norm else head
+
 # if __name__ == "__main__":
 #     sample_texts = ["Hello world", "Azure OpenAI embeddings test"]
 #     vectors = embed_texts(sample_texts)
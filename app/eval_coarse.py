@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+from statistics import mean
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.search.documents.models import VectorizedQuery
+from dotenv import load_dotenv
+from app.embed import COARSE_DIM, embed_query
+from app.main import HIT_FIELDS, two_stage_search
+
+load_dotenv()
+
+SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
+INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX")
+
+TOP_K = 10
+SHORTLISTS = [50, 100, 200, 400]
+
+sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+
+
+def full_search(vec):
+    """Ground truth: exhaustive kNN over the full-dimension vectors"""
+    vq = VectorizedQuery(vector=vec, k_nearest_neighbors=TOP_K, fields="embedding", exhaustive=True)
+    return {r["chunk_id"] for r in sc.search(search_text=None, vector_queries=[vq], top=TOP_K, select=["chunk_id"])}
+
+
+def single_stage_search(vec):
+    """Latency baseline: today's single-stage HNSW query over the full-dimension vectors"""
+    start = time.perf_counter()
+    vq = VectorizedQuery(vector=vec, k_nearest_neighbors=TOP_K, fields="embedding")
+    ids = [r["chunk_id"] for r in sc.search(search_text=None, vector_queries=[vq], top=TOP_K, select=HIT_FIELDS)]
+    return ids, time.perf_counter() - start
+
+
+def coarse_search(vec, shortlist_k):
+    """The exact two-stage path /search runs"""
+    start = time.perf_counter()
+    _, results = two_stage_search(sc, vec, TOP_K, shortlist_k, None)
+    return [r["chunk_id"] for r in results], time.perf_counter() - start
+
+
+def report(label, vecs, truth, search):
+    recalls, lats = [], []
+    for q, vec in vecs.items():
+        ids, lat = search(vec)
+        recalls.append(len(truth[q] & set(ids)) / len(truth[q]) if truth[q] else 1.0)
+        lats.append(lat)
+    print(f"{label}: recall@{TOP_K}={mean(recalls):.3f} latency={mean(lats) * 1000:.1f}ms")
+
+
+def evaluate(queries: list[str]):
+    vecs = {q: embed_query(q) for q in queries}
+    dim = len(next(iter(vecs.values())))
+    truth = {q: full_search(vec) for q, vec in vecs.items()}
+
+    report(f"single-stage {dim}-d HNSW", vecs, truth, single_stage_search)
+    for shortlist_k in SHORTLISTS:
+        report(f"two-stage {COARSE_DIM}-d shortlist={shortlist_k}", vecs, truth, lambda vec: coarse_search(vec, shortlist_k))
+
+
+if __name__ == "__main__":
+    if not COARSE_DIM:
+        print("AZURE_SEARCH_COARSE_DIM must be set to the dimension of the indexed embedding_coarse field")
+        sys.exit(1)
+    # Usage: python -m app.eval_coarse queries.txt  (one query per line, run from the repo root)
+    if len(sys.argv) != 2:
+        print("Usage: python -m app.eval_coarse <queries.txt>")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    if not queries:
+        print(f"No queries found in {sys.argv[1]}")
+        sys.exit(1)
+    evaluate(queries)
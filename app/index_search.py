@@ -1,6 +1,6 @@
 import os
 from azure.core.credentials import AzureKeyCredential
-from azure.core.exceptions import ResourceExistsError, HttpResponseError
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, HttpResponseError
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -33,11 +33,11 @@ for field in index.fields:
     print(f"- {field.name} ({field.type})")
 
 
-def ensure_index(dim: int):
+def ensure_index(dim: int, coarse_dim: int | None = None, dedup: bool = False):
     sic = SearchIndexClient(SEARCH_ENDPOINT, AzureKeyCredential(SEARCH_KEY))
 
     fields = [
-        SimpleField(name="chunk_id", type=SearchFieldDataType.String, key=True),
+        SimpleField(name="chunk_id", type=SearchFieldDataType.String, key=True, filterable=True),
         SimpleField(name="pdf_id", type=SearchFieldDataType.String, filterable=True, facetable=True),
         SimpleField(name="year", type=SearchFieldDataType.Int32, filterable=True, facetable=True),
         SimpleField(name="month", type=SearchFieldDataType.Int32, filterable=True, facetable=True),
@@ -53,6 +53,20 @@ def ensure_index(dim: int):
         SimpleField(name="source_blob_url", type=SearchFieldDataType.String, filterable=False, sortable=False),
     ]
 
+    # Low-dimensional Matryoshka projection used for first-stage candidate generation
+    if coarse_dim:
+        fields.append(SearchField(
+            name="embedding_coarse",
+            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            vector_search_dimensions=coarse_dim,
+            vector_search_profile_name="default"
+        ))
+
+    # Near-duplicate provenance: which canonical chunk a copy points to, and where a canonical was repeated
+    if dedup:
+        fields.append(SimpleField(name="duplicate_of", type=SearchFieldDataType.String, filterable=True))
+        fields.append(SimpleField(name="duplicate_sources", type=SearchFieldDataType.Collection(SearchFieldDataType.String), filterable=True))
+
     vector_search = VectorSearch(
         profiles=[{"name": "default", "algorithm": "hnsw"}],
         algorithms=[{"name": "hnsw", "kind": "hnsw"}]
@@ -73,13 +87,19 @@ def ensure_index(dim: int):
     )
 
     try:
+        existing = sic.get_index(INDEX_NAME)
+    except ResourceNotFoundError:
         sic.create_index(index)
         print(f"[INFO] Created new index {INDEX_NAME}")
-    except Exception as e:
-        if "ResourceNameAlreadyInUse" in str(e):
-            print(f"[INFO] Index {INDEX_NAME} already exists — using existing index")
-        else:
-            raise
+        return
+
+    # Azure allows adding fields to a live index but not changing existing ones, so only append what's missing
+    known = {f.name for f in existing.fields}
+    missing = [f for f in fields if f.name not in known]
+    if missing:
+        existing.fields.extend(missing)
+        sic.create_or_update_index(existing)
+        print(f"[INFO] Added fields {[f.name for f in missing]} to index {INDEX_NAME}")
 
 def upsert_chunks(docs: list[dict], batch_size: int = 1000):
     
@@ -98,3 +118,59 @@ def upsert_chunks(docs: list[dict], batch_size: int = 1000):
 
     return results
 
+def merge_provenance(sources: dict, batch_size: int = 1000):
+    """Add near-duplicate sources to canonical chunks.
+
+    duplicate_sources is replaced wholesale by a merge, so union with what the
+    index already holds rather than overwriting another worker's entries.
+    Uses merge (not upload) so an update can never create a bare document
+    without text or vector.
+    """
+    sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+
+    current = get_documents(list(sources), ["duplicate_sources"])
+    docs = []
+    for cid, srcs in sources.items():
+        if cid not in current:
+            print(f"[WARN] Canonical chunk {cid} not found in index, skipping provenance")
+            continue
+        existing = current[cid].get("duplicate_sources") or []
+        docs.append({"chunk_id": cid, "duplicate_sources": existing + [s for s in srcs if s not in existing]})
+
+    for i in range(0, len(docs), batch_size):
+        batch = docs[i:i + batch_size]
+        for r in sc.merge_documents(documents=batch):
+            if not r.succeeded:
+                print(f"[WARN] Provenance update failed for {r.key}: {r.error_message}")
+
+def get_documents(chunk_ids: list[str], fields: list[str], batch_size: int = 500) -> dict:
+
+    sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+
+    # search.in needs a filterable key; indexes created before that flag was set fall back to point lookups
+    key_filterable = any(f.name == "chunk_id" and f.filterable for f in index.fields)
+
+    out = {}
+    for i in range(0, len(chunk_ids), batch_size):
+        batch = chunk_ids[i:i + batch_size]
+        if key_filterable:
+            delim = next(d for d in "|,;~^" if not any(d in cid for cid in batch))
+            ids = delim.join(cid.replace("'", "''") for cid in batch)
+            for r in sc.search(search_text="*", filter=f"search.in(chunk_id, '{ids}', '{delim}')", select=["chunk_id"] + fields, top=len(batch)):
+                out[r["chunk_id"]] = r
+        else:
+            for cid in batch:
+                try:
+                    out[cid] = sc.get_document(key=cid, selected_fields=["chunk_id"] + fields)
+                except ResourceNotFoundError:
+                    pass
+
+    return out
+
+def get_embeddings(chunk_ids: list[str]) -> dict:
+
+    docs = get_documents(chunk_ids, ["embedding"])
+    missing = [cid for cid in chunk_ids if cid not in docs]
+    if missing:
+        print(f"[WARN] {len(missing)} canonical chunks not found in index")
+    return {cid: doc.get("embedding") for cid, doc in docs.items()}
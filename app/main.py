@@ -1,10 +1,18 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import os, requests
+import os, json, time, threading, itertools
 from azure.core.credentials import AzureKeyCredential
+from azure.storage.blob import BlobServiceClient
 from azure.search.documents import SearchClient
+from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.models import VectorizedQuery
-from azure.core.exceptions import HttpResponseError
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceExistsError, ResourceModifiedError
+from app.circuit_breaker import CircuitBreaker, is_service_failure
+from app.embed import COARSE_DIM, embed_query, truncate_embedding
+from app.cursor import MAX_SKIP, as_float32, encode_cursor, decode_cursor
+from app.corpus_stats import STATS_BLOB, CorpusStats, dump_stats, load_stats
 
 app = FastAPI(title="Magazine Search API")
 
@@ -19,135 +27,331 @@ EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL", "text-embedding-3-large")
 if not all([SEARCH_ENDPOINT, SEARCH_KEY, INDEX_NAME, AOAI_ENDPOINT, AOAI_KEY]):
     raise EnvironmentError("Missing required Azure or OpenAI environment variables.")
 
+# Corpus stats are written by the ingestion pipeline next to the OCR output; without storage they come from count/facet queries
+STORAGE_CONN_STR = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+OUTPUT_CONTAINER = os.getenv("AZURE_STORAGE_OUTPUT_CONTAINER_NAME")
+STATS_TTL_SECONDS = int(os.getenv("STATS_TTL_SECONDS", 60))
+stats_container = (
+    BlobServiceClient.from_connection_string(STORAGE_CONN_STR).get_container_client(OUTPUT_CONTAINER)
+    if STORAGE_CONN_STR and OUTPUT_CONTAINER else None
+)
+# Fields a hit is rendered from; never pull the vectors unless a rerank needs them.
+# Optional fields (dedup provenance) are only selected when the index has them.
+_index = SearchIndexClient(SEARCH_ENDPOINT, AzureKeyCredential(SEARCH_KEY)).get_index(INDEX_NAME)
+INDEX_FIELDS = {f.name for f in _index.fields}
+EMBED_DIM = next(f.vector_search_dimensions for f in _index.fields if f.name == "embedding")
+HIT_FIELDS = [f for f in ("chunk_id", "pdf_id", "year", "month", "page_start", "text", "source_blob_url", "duplicate_of", "duplicate_sources") if f in INDEX_FIELDS]
+
+_snapshot, _snapshot_at = None, 0.0
+_refresh_lock = threading.Lock()
+
 
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 10
     year: int | None = None
     month: int | None = None
+    two_stage: bool = False
+    shortlist_k: int = 200
+    paginate: bool = False
+    cursor: str | None = None
+    stream: bool = False
 
-def embed_query(q: str) -> list[float]:
-    if not q.strip():
-        return []
-    url = f"{AOAI_ENDPOINT}/openai/deployments/{EMBED_MODEL}/embeddings?api-version=2024-06-01"
-    headers = {"api-key": AOAI_KEY, "Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, json={"input": q})
-    resp.raise_for_status()
-    data = resp.json()
-    if "data" not in data or not data["data"]:
-        raise ValueError("Embedding API returned empty response.")
-    return data["data"][0]["embedding"]
+def rerank_full(results: list, vec: list[float], top_k: int) -> list:
+    # Second stage: rescore the coarse shortlist with the full-dimension vectors
+    scored = []
+    for r in results:
+        emb = r.get("embedding")
+        if not emb:
+            continue
+        r["@search.score"] = sum(a * b for a, b in zip(vec, emb))
+        scored.append(r)
+    scored.sort(key=lambda r: r["@search.score"], reverse=True)
+    return scored[:top_k]
 
+def two_stage_search(sc: SearchClient, vec: list[float], top_k: int, shortlist_k: int, filt_str: str | None):
+    """Coarse-to-fine retrieval.
 
-@app.post("/search") 
-def search(req: SearchRequest):
-    try:
-        vec = embed_query(req.query)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Embedding failed: {e}")
+    Stage one is a vector-only kNN over the truncated projection: keyword and
+    semantic scores would be thrown away by the rerank, so they aren't paid
+    for. Stage two rescores the shortlist with the full vectors.
+    """
+    shortlist_k = max(shortlist_k, top_k)
+    vq = VectorizedQuery(vector=truncate_embedding(vec, COARSE_DIM), k_nearest_neighbors=shortlist_k, fields="embedding_coarse")
+    resp = sc.search(
+        search_text=None,
+        vector_queries=[vq],
+        top=shortlist_k,
+        filter=filt_str,
+        select=HIT_FIELDS + ["embedding"],
+        include_total_count=True
+    )
+    return resp, rerank_full(list(resp), vec, top_k)
 
-    sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
 
+MODES = ["semantic", "vector+keyword", "vector+keyword_no_filter"]
+NO_FILTER_MODE = MODES[-1]
+# Only semantic may be skipped on circuit state: skipping vector+keyword would land
+# filtered requests on the no-filter mode for a whole cooldown
+breaker = CircuitBreaker(
+    MODES,
+    skippable=("semantic",),
+    failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", 3)),
+    cooldown=float(os.getenv("BREAKER_COOLDOWN_SECONDS", 30)),
+    max_cooldown=float(os.getenv("BREAKER_MAX_COOLDOWN_SECONDS", 300)),
+)
+# Exports (paginate/cursor/stream) skip semantic ranking, which only reranks the top 50 hits,
+# and pin k for the whole session so hybrid fusion ranks every page the same way
+EXPORT_MODE = "vector+keyword"
+TWO_STAGE_MODE = "vector_two_stage"
+CURSOR_K = int(os.getenv("SEARCH_CURSOR_K", 1000))
+
+def build_filter(year: int | None, month: int | None) -> str | None:
     filt = []
-    if req.year is not None: filt.append(f"year eq {req.year}")
-    if req.month is not None: filt.append(f"month eq {req.month}")
-    filt_str = " and ".join(filt) if filt else None
+    if year is not None: filt.append(f"year eq {year}")
+    if month is not None: filt.append(f"month eq {month}")
+    return " and ".join(filt) if filt else None
 
-    vq = VectorizedQuery(vector=vec, k_nearest_neighbors=req.top_k, fields="embedding")
-    results, mode = None, "semantic"
-    total_count = None
+def mode_kwargs(mode: str, filt_str: str | None) -> dict:
+    kwargs = {}
+    if mode != NO_FILTER_MODE:
+        kwargs["filter"] = filt_str
+    if mode == "semantic":
+        kwargs.update(semantic_configuration_name="default", query_type="semantic")
+    return kwargs
 
-    try:
-        resp = sc.search(
-            search_text=req.query,
-            vector_queries=[vq],
-            top=req.top_k,
-            filter=filt_str,
-            semantic_configuration_name="default",
-            query_type="semantic",
-            include_total_count=True
-        )
-        results = list(resp)
-        try:
-            total_count = resp.get_count()
-        except Exception:
-            total_count = None
-    except HttpResponseError:
+def run_search(sc: SearchClient, query: str, vq: VectorizedQuery, top: int, filt_str: str | None, skip: int = 0, mode: str = MODES[0], fallback: bool = True):
+    """Run the search with semantic -> vector+keyword -> no-filter fallback.
 
-        mode = "vector+keyword"
+    Semantic is skipped outright while its circuit is open (and probed in
+    the background); the other modes are only reached by falling back from
+    an error, so no-filter answers never come from circuit state alone.
+    With fallback=False only `mode` is tried, whatever its circuit state, so
+    cursor pages keep the ranking they started with. Only the first page is fetched here (so
+    fallback errors surface); the rest is pulled lazily from the returned
+    iterator.
+    """
+    modes = MODES[MODES.index(mode):] if fallback else [mode]
+    skipped = []
+    for m in modes:
+        kwargs = mode_kwargs(m, filt_str)
+        if fallback and m in breaker.skippable and not breaker.allow(m):
+            # Probe without this request's filter so a bad filter can't keep the circuit open
+            breaker.maybe_probe(m, lambda kw=mode_kwargs(m, None): list(sc.search(search_text=query, vector_queries=[vq], top=1, **kw)))
+            skipped.append(m)
+            continue
+        start = time.perf_counter()
         try:
             resp = sc.search(
-                search_text=req.query,
+                search_text=query,
                 vector_queries=[vq],
-                top=req.top_k,
-                filter=filt_str,
-                include_total_count=True
+                top=top,
+                skip=skip or None,
+                select=HIT_FIELDS,
+                include_total_count=True,
+                **kwargs
             )
-            results = list(resp)
-            try:
-                total_count = resp.get_count()
-            except Exception:
-                total_count = None
-        except HttpResponseError:
-
-            mode = "vector+keyword_no_filter"
-            resp = sc.search(
-                search_text=req.query,
-                vector_queries=[vq],
-                top=req.top_k,
-                include_total_count=True
-            )
-            results = list(resp)
-            try:
-                total_count = resp.get_count()
-            except Exception:
-                total_count = None
-
-    out = []
-    for i, r in enumerate(results):
-        out.append({
-            "rank": i+1,
-            "score": r.get("@search.score", 0.0),
-            "pdf_id": r.get("pdf_id"),
-            "year": r.get("year"),
-            "month": r.get("month"),
-            "page": r.get("page_start"),
-            "chunk_id": r.get("chunk_id"),
-            "source_blob_url": r.get("source_blob_url"),
-            "snippet": (r.get("text")[:250] + "…") if r.get("text") else ""
-        })
+            it = iter(resp)
+            first = next(it, None)
+        except AzureError as e:
+            # Transport errors (ServiceRequestError/ServiceResponseError) carry no status code
+            if is_service_failure(m, getattr(e, "status_code", None), str(e)):
+                breaker.record_failure(m)
+            if m == modes[-1]:
+                raise
+            continue
+        breaker.record_success(m, time.perf_counter() - start)
+        return resp, itertools.chain([] if first is None else [first], it), m, skipped
+
+def get_count(resp):
+    try:
+        return resp.get_count()
+    except Exception:
+        return None
 
+def format_hit(r, rank: int) -> dict:
     return {
-        "query": req.query,
+        "rank": rank,
+        "score": r.get("@search.score", 0.0),
+        "pdf_id": r.get("pdf_id"),
+        "year": r.get("year"),
+        "month": r.get("month"),
+        "page": r.get("page_start"),
+        "chunk_id": r.get("chunk_id"),
+        "source_blob_url": r.get("source_blob_url"),
+        "duplicate_of": r.get("duplicate_of"),
+        "also_appears_in": r.get("duplicate_sources") or [],
+        "snippet": (r.get("text")[:250] + "…") if r.get("text") else ""
+    }
+
+
+@app.post("/search") 
+def search(req: SearchRequest):
+    if req.two_stage and not COARSE_DIM:
+        raise HTTPException(status_code=400, detail="two_stage requires AZURE_SEARCH_COARSE_DIM to be configured")
+    export = req.paginate or req.stream or bool(req.cursor)
+    if req.two_stage and export:
+        raise HTTPException(status_code=400, detail="two_stage does not support cursor pagination or streaming")
+
+    if req.cursor:
+        try:
+            state = decode_cursor(req.cursor, MODES, EMBED_DIM)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query, vec, year, month = state["query"], state["vec"], state["year"], state["month"]
+        skip, k, mode = state["skip"], state["k"], state["mode"]
+    else:
+        try:
+            vec = as_float32(embed_query(req.query))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Embedding failed: {e}")
+        query, year, month, skip = req.query, req.year, req.month, 0
+        if export:
+            k, mode = max(req.top_k, CURSOR_K), EXPORT_MODE
+        else:
+            k, mode = req.top_k, MODES[0]
+
+    filt_str = build_filter(year, month)
+    sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+
+    if req.two_stage:
+        resp, results = two_stage_search(sc, vec, req.top_k, req.shortlist_k, filt_str)
+        hits, mode, skipped = iter(results), TWO_STAGE_MODE, []
+    else:
+        vq = VectorizedQuery(vector=vec, k_nearest_neighbors=k, fields="embedding")
+        try:
+            resp, hits, mode, skipped = run_search(sc, query, vq, req.top_k, filt_str, skip=skip, mode=mode, fallback=not req.cursor)
+        except AzureError as e:
+            if not req.cursor:
+                raise
+            if not is_service_failure(mode, getattr(e, "status_code", None), str(e)):
+                raise HTTPException(status_code=400, detail=f"Search rejected this cursor: {e}")
+            # Continuing in another mode would page through a different ranking
+            raise HTTPException(status_code=503, detail=f"Search mode '{mode}' for this cursor is unavailable, restart without a cursor: {e}")
+    total_count = get_count(resp)
+    filter_applied = None if mode == NO_FILTER_MODE else filt_str
+
+    def next_cursor(returned: int):
+        if not export or returned < req.top_k or skip + returned > MAX_SKIP:
+            return None
+        return encode_cursor({"query": query, "vec": vec, "year": year, "month": month, "skip": skip + returned, "k": k, "mode": mode})
+
+    if req.stream:
+        def ndjson():
+            yield json.dumps({"query": query, "filter_applied": filter_applied, "mode": mode, "modes_skipped": skipped, "count": total_count}) + "\n"
+            returned = 0
+            for r in hits:
+                returned += 1
+                yield json.dumps(format_hit(r, skip + returned)) + "\n"
+            yield json.dumps({"next_cursor": next_cursor(returned)}) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    results = list(hits)
+    out = [format_hit(r, skip + i + 1) for i, r in enumerate(results)]
+
+    return {
+        "query": query,
         "top_k": req.top_k,
-        "filter_applied": filt_str,
+        "filter_applied": filter_applied,
         "mode": mode,
+        "modes_skipped": skipped,
+        "two_stage": req.two_stage,
         "count": total_count,
-        "results": out
+        "results": out,
+        "next_cursor": next_cursor(len(out))
     }
 
-@app.get("/debug/index")
-def debug_index():
+def recompute_stats() -> CorpusStats:
+    """Rebuild corpus stats by scanning the index one pdf_id at a time.
+
+    A single match-all scan pages with $skip and fails past 100,000 chunks;
+    no one issue comes close to that.
+    """
     sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+    facets = sc.search(search_text="*", facets=["pdf_id,count:100000"], top=0).get_facets() or {}
+    pdfs, sample = {}, None
+    for f in facets.get("pdf_id", []):
+        pdf_id = f["value"]
+        p = pdfs[pdf_id] = {"year": None, "month": None, "chunks": 0, "chars": 0}
+        flt = "pdf_id eq '{}'".format(pdf_id.replace("'", "''"))
+        for r in sc.search(search_text="*", filter=flt, select=["chunk_id", "pdf_id", "year", "month", "page_start", "text"]):
+            p["year"], p["month"] = r.get("year"), r.get("month")
+            p["chunks"] += 1
+            p["chars"] += len(r.get("text") or "")
+            if sample is None:
+                sample = {k: r.get(k) for k in ("chunk_id", "pdf_id", "year", "month", "page_start")}
+    stats = CorpusStats()
+    stats.replace_all(pdfs, sample)
+    return stats
+
+def query_stats() -> dict:
+    """Count, year/month facets and a sample straight from the index, for deployments without storage"""
+    sc = SearchClient(SEARCH_ENDPOINT, INDEX_NAME, AzureKeyCredential(SEARCH_KEY))
+    total_docs = sc.search(search_text="*", top=0, include_total_count=True).get_count()
+    facets_resp = sc.search(search_text="*", facets=["year,count:50", "month,count:12"], top=0)
+    sample = []
+    for r in sc.search(search_text="*", top=1):
+        sample.append({k: r.get(k) for k in ("chunk_id", "pdf_id", "year", "month", "page_start")})
+    return {
+        "total_docs": total_docs,
+        "facets": facets_resp.get_facets(),
+        "sample": sample
+    }
+
+def load_snapshot(refresh: bool) -> dict:
+    if stats_container is None:
+        return query_stats()
+    if refresh:
+        blob = stats_container.get_blob_client(STATS_BLOB)
+        etag = blob.get_blob_properties().etag if blob.exists() else None
+        stats = recompute_stats()
+        try:
+            if etag:
+                blob.upload_blob(dump_stats(stats), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+            else:
+                blob.upload_blob(dump_stats(stats), overwrite=False)
+        except (ResourceModifiedError, ResourceExistsError):
+            # The pipeline recorded an issue mid-scan; its copy is newer for that issue, so keep it
+            print("[WARN] Corpus stats changed during refresh, not overwriting the stored copy")
+        return stats.snapshot
+    # Pick up what the ingestion pipeline has written since the last load
+    return load_stats(stats_container).snapshot
+
+def get_snapshot(refresh: bool = False) -> dict:
+    global _snapshot, _snapshot_at
+
+    def fresh():
+        return _snapshot is not None and time.monotonic() - _snapshot_at <= STATS_TTL_SECONDS
+
+    if not refresh and fresh():
+        return _snapshot
+    # One caller reloads; everyone else keeps serving the previous snapshot instead of waiting on it
+    if not _refresh_lock.acquire(blocking=refresh or _snapshot is None):
+        return _snapshot
     try:
-        total_docs = sc.search(search_text="*", top=0, include_total_count=True).get_count()
-        facets_resp = sc.search(search_text="*", facets=["year,count:50", "month,count:12"], top=0)
-        sample = []
-        for r in sc.search(search_text="*", top=1):
-            sample.append({
-                "chunk_id": r.get("chunk_id"),
-                "pdf_id": r.get("pdf_id"),
-                "year": r.get("year"),
-                "month": r.get("month"),
-                "page_start": r.get("page_start"),
-            })
-            break
+        if refresh or not fresh():
+            _snapshot = load_snapshot(refresh)
+            _snapshot_at = time.monotonic()
+        return _snapshot
+    finally:
+        _refresh_lock.release()
+
+@app.get("/debug/index")
+def debug_index(refresh: bool = False):
+    try:
+        snapshot = get_snapshot(refresh)
     except HttpResponseError as e:
         raise HTTPException(status_code=500, detail=f"Search debug failed: {e}")
 
     return {
         "index": INDEX_NAME,
-        "total_docs": total_docs,
-        "facets": getattr(facets_resp, "facets", None),
-        "sample": sample
+        **snapshot
+    }
+
+@app.get("/debug/search-modes")
+def debug_search_modes():
+    return {
+        "order": MODES,
+        "modes": breaker.snapshot()
     }
@@ -1,12 +1,19 @@
 import os
 import sys
 import json
+import gzip
+import math
 import time
+import threading
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient
 from normalize import normalize_ocr
 from chunking import chunk_pages
-from embed import embed_texts
-from index_search import ensure_index, upsert_chunks
+from corpus_stats import STATS_BLOB, CorpusStats, dump_stats, parse_stats
+from dedup import DedupIndex, dedup_chunks
+from embed import COARSE_DIM, embed_texts, truncate_embedding
+from index_search import ensure_index, upsert_chunks, merge_provenance, get_embeddings
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -29,6 +36,19 @@ BATCH_SIZE = 16
 MAX_RETRIES = 5
 BACKOFF_FACTOR = 2
 
+# Near-duplicate handling: "off", "reuse" (index copy with the canonical vector) or "drop" (provenance only)
+DEDUP_POLICY = os.getenv("DEDUP_POLICY", "off")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+DEDUP_INDEX_BLOB = "dedup_index.json.gz"
+if DEDUP_POLICY not in ("off", "reuse", "drop"):
+    raise ValueError(f"Unsupported DEDUP_POLICY: {DEDUP_POLICY}")
+dedup_blob = output_container.get_blob_client(DEDUP_INDEX_BLOB)
+_dedup_index, _dedup_etag = None, None
+_dedup_load_lock = threading.Lock()
+_dedup_save_lock = threading.Lock()
+stats_blob = output_container.get_blob_client(STATS_BLOB)
+_stats_save_lock = threading.Lock()
+
 
 def embed_texts_batch(texts):
     import requests
@@ -67,6 +87,68 @@ def load_ocr_json_from_blob(json_path: str) -> dict:
     return json.loads(blob.readall().decode("utf-8"))
 
 
+def get_dedup_index() -> DedupIndex:
+    """Load the corpus-wide near-duplicate index from blob storage once per process"""
+    global _dedup_index, _dedup_etag
+    with _dedup_load_lock:
+        if _dedup_index is None:
+            try:
+                download = dedup_blob.download_blob()
+                _dedup_index = DedupIndex.from_dict(json.loads(gzip.decompress(download.readall())), threshold=DEDUP_THRESHOLD)
+                _dedup_etag = download.properties.etag
+                print(f"[INFO] Loaded dedup index with {len(_dedup_index.signatures)} signatures")
+            except ResourceNotFoundError:
+                _dedup_index = DedupIndex(threshold=DEDUP_THRESHOLD)
+    return _dedup_index
+
+
+def save_dedup_index(index: DedupIndex):
+    """Write the index back only if no other instance has since; on conflict merge theirs in and retry"""
+    global _dedup_etag
+    with _dedup_save_lock:
+        for attempt in range(1, MAX_RETRIES + 1):
+            raw = gzip.compress(json.dumps(index.to_dict()).encode("utf-8"))
+            try:
+                if _dedup_etag:
+                    resp = dedup_blob.upload_blob(raw, overwrite=True, etag=_dedup_etag, match_condition=MatchConditions.IfNotModified)
+                else:
+                    resp = dedup_blob.upload_blob(raw, overwrite=False)
+                _dedup_etag = resp["etag"]
+                return
+            except (ResourceModifiedError, ResourceExistsError):
+                print(f"[WARN] Dedup index changed in storage, merging and retrying (Attempt {attempt})")
+                download = dedup_blob.download_blob()
+                index.merge(DedupIndex.from_dict(json.loads(gzip.decompress(download.readall()))))
+                _dedup_etag = download.properties.etag
+        raise RuntimeError(f"Failed to save dedup index after {MAX_RETRIES} attempts")
+
+
+def record_corpus_stats(pdf_id: str, year: int, month: int, chunks: list[dict]):
+    """Fold this issue's indexed chunks into the persisted corpus stats served by /debug/index.
+
+    Read-modify-write against the stored blob under its ETag, so other
+    workers, other instances and /debug/index?refresh=true never lose
+    each other's updates.
+    """
+    with _stats_save_lock:
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                download = stats_blob.download_blob()
+                stats, etag = parse_stats(download.readall()), download.properties.etag
+            except ResourceNotFoundError:
+                stats, etag = CorpusStats(), None
+            stats.record_issue(pdf_id, year, month, chunks)
+            try:
+                if etag:
+                    stats_blob.upload_blob(dump_stats(stats), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+                else:
+                    stats_blob.upload_blob(dump_stats(stats), overwrite=False)
+                return
+            except (ResourceModifiedError, ResourceExistsError):
+                print(f"[WARN] Corpus stats changed in storage, reloading and retrying (Attempt {attempt})")
+        raise RuntimeError(f"Failed to save corpus stats after {MAX_RETRIES} attempts")
+
+
 def process_issue_from_json(json_path: str, pdf_id: str, year: int, month: int, source_url: str):
     # Load OCR JSON
     doc = load_ocr_json_from_blob(json_path)
@@ -75,21 +157,72 @@ def process_issue_from_json(json_path: str, pdf_id: str, year: int, month: int,
     pages = normalize_ocr(doc, pdf_id, year, month, source_url)
 
     # Chunk pages
-    chunks = chunk_pages(pages)
+    chunks = [c for c in chunk_pages(pages) if c.get("text")]
+    total = len(chunks)
 
-    # Generate embeddings batch-wise with retry
-    texts = [c["text"] for c in chunks if c.get("text")]
-    if texts:
-        embs = embed_texts_batch(texts)
-        for c, e in zip(chunks, embs):
-            c["embedding"] = e
+    # Skip near-duplicates (mastheads, ads, TOCs repeated across issues) before paying for embeddings
+    duplicates, signatures = [], {}
+    if DEDUP_POLICY != "off" and chunks:
+        dedup_index = get_dedup_index()
+        chunks, duplicates, signatures = dedup_chunks(chunks, dedup_index)
 
-        ensure_index(dim=len(embs[0]) if embs else 3072)
+    # Generate embeddings batch-wise with retry
+    texts = [c["text"] for c in chunks]
+    embs = embed_texts_batch(texts) if texts else []
+    embed_calls = math.ceil(len(texts) / BATCH_SIZE)
+    for c, e in zip(chunks, embs):
+        c["embedding"] = e
+
+    if duplicates:
+        by_id = {c["chunk_id"]: c for c in chunks}
+
+        if DEDUP_POLICY == "reuse":
+            vectors = get_embeddings(list({canon for _, canon in duplicates if canon not in by_id}))
+            vectors.update({cid: c["embedding"] for cid, c in by_id.items()})
+            orphans = []
+            for c, canon in duplicates:
+                if vectors.get(canon):
+                    c["embedding"] = vectors[canon]
+                    c["duplicate_of"] = canon
+                    chunks.append(c)
+                else:
+                    orphans.append(c)
+            # Canonical vector unavailable: embed these after all
+            if orphans:
+                for c, e in zip(orphans, embed_texts_batch([c["text"] for c in orphans])):
+                    c["embedding"] = e
+                    chunks.append(c)
+                embed_calls += math.ceil(len(orphans) / BATCH_SIZE)
+                texts.extend(c["text"] for c in orphans)
+
+    if chunks:
+        if COARSE_DIM:
+            for c in chunks:
+                c["embedding_coarse"] = truncate_embedding(c["embedding"], COARSE_DIM)
+
+        ensure_index(dim=len(chunks[0]["embedding"]), coarse_dim=COARSE_DIM, dedup=DEDUP_POLICY != "off")
         upsert_chunks(chunks)
+        record_corpus_stats(pdf_id, year, month, chunks)
         print(f"Indexed {len(chunks)} chunks for {pdf_id}")
+    elif duplicates:
+        # Every chunk was a dropped near-duplicate; the issue still counts towards the corpus
+        record_corpus_stats(pdf_id, year, month, [])
+        print(f"All chunks for {pdf_id} were near-duplicates; updated provenance only")
     else:
         print(f"No text found in chunks for {pdf_id}")
 
+    # Canonicals become matchable only now that they are searchable
+    if DEDUP_POLICY != "off" and total:
+        dedup_index.commit(signatures, duplicates)
+        save_dedup_index(dedup_index)
+        # Provenance lives on the canonical chunk so search can attribute repeats. Taken after the
+        # ETag-merged save so it includes other instances' sources; merge_provenance unions with the index too.
+        if duplicates:
+            merge_provenance(dedup_index.sources_for({canon for _, canon in duplicates}))
+        saved_calls = math.ceil(total / BATCH_SIZE) - embed_calls
+        print(f"[DEDUP] {pdf_id}: {len(duplicates)}/{total} chunks near-duplicate ({len(duplicates) / total:.1%}), "
+              f"policy={DEDUP_POLICY}, saved {total - len(texts)} embedding inputs / {saved_calls} calls")
+
 if __name__ == "__main__":
     if len(sys.argv) == 6:
         json_path, pdf_id, year, month, source_url = sys.argv[1:]
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from app.circuit_breaker import CircuitBreaker, is_service_failure
+
+
+def wait_for(predicate, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def make_breaker(**kwargs):
+    kwargs.setdefault("failure_threshold", 2)
+    kwargs.setdefault("cooldown", 0.05)
+    return CircuitBreaker(["semantic", "vector+keyword"], skippable=("semantic",), **kwargs)
+
+
+def test_opens_after_consecutive_failures():
+    breaker = make_breaker()
+    breaker.record_failure("semantic")
+    assert breaker.allow("semantic")
+    breaker.record_failure("semantic")
+    assert not breaker.allow("semantic")
+    assert breaker.allow("vector+keyword")
+    assert breaker.snapshot()["semantic"]["state"] == "open"
+
+
+def test_non_skippable_mode_never_opens():
+    breaker = make_breaker()
+    for _ in range(5):
+        breaker.record_failure("vector+keyword")
+    assert breaker.allow("vector+keyword")
+    snap = breaker.snapshot()["vector+keyword"]
+    assert snap["state"] == "closed"
+    assert snap["consecutive_failures"] == 5 and snap["errors"] == 5
+
+
+def test_success_resets_failure_count():
+    breaker = make_breaker()
+    breaker.record_failure("semantic")
+    breaker.record_success("semantic", 0.01)
+    breaker.record_failure("semantic")
+    assert breaker.allow("semantic")
+
+
+def test_no_probe_before_cooldown():
+    breaker = make_breaker(cooldown=60)
+    breaker.record_failure("semantic")
+    breaker.record_failure("semantic")
+    calls = []
+    breaker.maybe_probe("semantic", lambda: calls.append(1))
+    time.sleep(0.02)
+    assert calls == []
+    assert breaker.snapshot()["semantic"]["state"] == "open"
+
+
+def test_half_open_probe_success_closes():
+    breaker = make_breaker()
+    breaker.record_failure("semantic")
+    breaker.record_failure("semantic")
+    time.sleep(0.06)
+
+    release = []
+    breaker.maybe_probe("semantic", lambda: wait_for(lambda: release))
+    assert breaker.snapshot()["semantic"]["state"] == "half_open"
+    assert not breaker.allow("semantic")
+    release.append(True)
+
+    wait_for(lambda: breaker.allow("semantic"))
+    snap = breaker.snapshot()["semantic"]
+    assert snap["state"] == "closed"
+    assert snap["calls"] == 3 and snap["errors"] == 2
+
+
+def test_half_open_probe_failure_reopens_with_longer_cooldown():
+    breaker = make_breaker()
+    breaker.record_failure("semantic")
+    breaker.record_failure("semantic")
+    time.sleep(0.06)
+
+    def probe():
+        raise RuntimeError("still down")
+
+    breaker.maybe_probe("semantic", probe)
+    wait_for(lambda: breaker.snapshot()["semantic"]["state"] == "open")
+    assert breaker.modes["semantic"].cooldown == pytest.approx(0.1)
+
+
+@pytest.mark.parametrize("mode, status, message, expected", [
+    ("semantic", 503, "Service unavailable", True),
+    ("semantic", 429, "Too many requests", True),
+    ("semantic", None, "connection reset", True),
+    ("semantic", 400, "Semantic search is not enabled for this service", True),
+    ("semantic", 400, "Semantic queries quota exceeded", True),
+    ("semantic", 400, "Invalid expression: 'year eq' is not a valid filter", False),
+    ("semantic", 400, "Unknown field 'embedding_coarse' in vector field list", False),
+    ("vector+keyword", 400, "Invalid expression in $filter", False),
+    ("vector+keyword", 502, "Bad gateway", True),
+])
+def test_is_service_failure(mode, status, message, expected):
+    assert is_service_failure(mode, status, message) is expected
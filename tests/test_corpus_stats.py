@@ -0,0 +1,76 @@
+import json
+import threading
+
+from app.corpus_stats import CorpusStats, dump_stats, parse_stats
+
+
+def chunks(pdf_id, year, month, texts):
+    return [{"chunk_id": f"{pdf_id}_p{i}_o0", "pdf_id": pdf_id, "year": year, "month": month, "page_start": i, "text": t}
+            for i, t in enumerate(texts, 1)]
+
+
+def test_aggregates_and_reindex_is_idempotent():
+    stats = CorpusStats()
+    stats.record_issue("2020-03", 2020, 3, chunks("2020-03", 2020, 3, ["abcd", "ab"]))
+    stats.record_issue("2020-03", 2020, 3, chunks("2020-03", 2020, 3, ["abcd", "ab"]))
+    stats.record_issue("2021-01", 2021, 1, chunks("2021-01", 2021, 1, ["abcdef"]))
+
+    snap = stats.snapshot
+    assert snap["total_docs"] == 3
+    assert snap["total_pdfs"] == 2
+    assert snap["avg_chunk_chars"] == 4.0
+    assert snap["facets"]["year"] == [{"value": 2020, "count": 2}, {"value": 2021, "count": 1}]
+    assert snap["by_year_month"] == {"2020-03": 2, "2021-01": 1}
+    assert snap["by_pdf_id"] == {"2020-03": 2, "2021-01": 1}
+
+
+def test_issue_with_no_indexed_chunks_still_counts():
+    stats = CorpusStats()
+    stats.record_issue("2020-04", 2020, 4, [])
+    assert stats.snapshot["total_pdfs"] == 1
+    assert stats.snapshot["total_docs"] == 0
+    assert stats.snapshot["sample"] == []
+
+
+def test_round_trip():
+    stats = CorpusStats()
+    stats.record_issue("2020-03", 2020, 3, chunks("2020-03", 2020, 3, ["abcd"]))
+    restored = CorpusStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+    assert restored.snapshot == stats.snapshot
+    restored.record_issue("2020-05", 2020, 5, chunks("2020-05", 2020, 5, ["ab"]))
+    assert restored.snapshot["total_pdfs"] == 2
+
+
+def test_serialize_while_recording():
+    stats = CorpusStats()
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            stats.record_issue(f"pdf-{i}", 2020, 1, [])
+            i += 1
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        for _ in range(200):
+            json.dumps(stats.to_dict())
+    finally:
+        stop.set()
+        t.join()
+
+
+def test_missing_year_month_does_not_break_snapshot():
+    stats = CorpusStats()
+    stats.record_issue("2020-03", 2020, 3, chunks("2020-03", 2020, 3, ["abcd"]))
+    stats.record_issue("undated", None, None, chunks("undated", None, None, ["ab"]))
+    snap = stats.snapshot
+    assert snap["facets"]["year"] == [{"value": 2020, "count": 1}, {"value": None, "count": 1}]
+    assert snap["by_year_month"] == {"2020-03": 1, "unknown": 1}
+
+
+def test_blob_round_trip():
+    stats = CorpusStats()
+    stats.record_issue("2020-03", 2020, 3, chunks("2020-03", 2020, 3, ["abcd"]))
+    assert parse_stats(dump_stats(stats)).snapshot == stats.snapshot
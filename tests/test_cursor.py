@@ -0,0 +1,81 @@
+import json
+import zlib
+import base64
+
+import pytest
+
+from app.cursor import MAX_SKIP, as_float32, encode_cursor, decode_cursor
+
+MODES = ["semantic", "vector+keyword", "vector+keyword_no_filter"]
+DIM = 4
+
+
+def make_state(**overrides):
+    state = {
+        "query": "tractor reviews",
+        "vec": as_float32([0.1, -0.25, 0.333, 1e-3]),
+        "year": 2021,
+        "month": None,
+        "skip": 20,
+        "k": 1000,
+        "mode": "vector+keyword",
+    }
+    state.update(overrides)
+    return state
+
+
+def tamper(token: str, **changes) -> str:
+    state = json.loads(zlib.decompress(base64.urlsafe_b64decode(token)))
+    state.update(changes)
+    return base64.urlsafe_b64encode(zlib.compress(json.dumps(state).encode("utf-8"))).decode("ascii")
+
+
+def test_round_trip_preserves_state():
+    state = make_state()
+    assert decode_cursor(encode_cursor(state), MODES, DIM) == state
+
+
+def test_float32_rounding_is_stable():
+    vec = [0.1, 0.2, 0.30000000000000004]
+    assert as_float32(as_float32(vec)) == as_float32(vec)
+
+
+def test_filter_string_is_not_carried():
+    token = encode_cursor({**make_state(), "filter": "pdf_id ne ''"})
+    assert "filter" not in decode_cursor(token, MODES, DIM)
+
+
+@pytest.mark.parametrize("token", ["", "not-base64!", base64.urlsafe_b64encode(b"garbage").decode("ascii")])
+def test_rejects_garbage(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, MODES, DIM)
+
+
+@pytest.mark.parametrize("changes", [
+    {"mode": "keyword_only"},
+    {"year": "2021 or true"},
+    {"month": True},
+    {"skip": -1},
+    {"skip": MAX_SKIP + 1},
+    {"k": 0},
+    {"query": None},
+    {"vec": "AAAA="},
+])
+def test_rejects_tampered_fields(changes):
+    token = tamper(encode_cursor(make_state()), **changes)
+    with pytest.raises(ValueError):
+        decode_cursor(token, MODES, DIM)
+
+
+def test_rejects_missing_fields():
+    state = json.loads(zlib.decompress(base64.urlsafe_b64decode(encode_cursor(make_state()))))
+    del state["k"]
+    token = base64.urlsafe_b64encode(zlib.compress(json.dumps(state).encode("utf-8"))).decode("ascii")
+    with pytest.raises(ValueError):
+        decode_cursor(token, MODES, DIM)
+
+
+def test_rejects_vector_of_wrong_dimension():
+    token = encode_cursor(make_state(vec=as_float32([0.5] * 8)))
+    with pytest.raises(ValueError):
+        decode_cursor(token, MODES, DIM)
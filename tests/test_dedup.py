@@ -0,0 +1,93 @@
+from app.dedup import DedupIndex, dedup_chunks, minhash, similarity
+
+MASTHEAD = ("Subscribe today to Farm Monthly and save 40 percent on the cover price, call 1-800-555-0100 "
+            "or visit our website for details about every offer in this issue and the next")
+ARTICLE = "Completely different article about tractors, soil health and planting schedules in early spring"
+
+
+def chunk(pdf_id, page, text):
+    return {"chunk_id": f"{pdf_id}_p{page}_o0", "pdf_id": pdf_id, "page_start": page, "text": text}
+
+
+def test_minhash_similarity():
+    assert similarity(minhash(MASTHEAD), minhash(MASTHEAD)) == 1.0
+    assert similarity(minhash(MASTHEAD), minhash(MASTHEAD.upper() + " now")) >= 0.8
+    assert similarity(minhash(MASTHEAD), minhash(ARTICLE)) < 0.5
+
+
+def test_detects_duplicates_within_issue():
+    index = DedupIndex()
+    chunks = [chunk("2021-03", 1, MASTHEAD), chunk("2021-03", 2, ARTICLE), chunk("2021-03", 9, MASTHEAD + " now")]
+    unique, duplicates, signatures = dedup_chunks(chunks, index)
+    assert [c["chunk_id"] for c in unique] == ["2021-03_p1_o0", "2021-03_p2_o0"]
+    assert [(c["chunk_id"], canon) for c, canon in duplicates] == [("2021-03_p9_o0", "2021-03_p1_o0")]
+    assert set(signatures) == {"2021-03_p1_o0", "2021-03_p2_o0"}
+
+
+def test_index_is_untouched_until_commit():
+    index = DedupIndex()
+    first = [chunk("2021-03", 1, MASTHEAD)]
+    _, _, signatures = dedup_chunks(first, index)
+    assert index.signatures == {}
+
+    # An uncommitted canonical must not be matched by another issue
+    unique, duplicates, _ = dedup_chunks([chunk("2021-04", 1, MASTHEAD)], index)
+    assert len(unique) == 1 and duplicates == []
+
+    index.commit(signatures, [])
+    unique, duplicates, _ = dedup_chunks([chunk("2021-04", 1, MASTHEAD)], index)
+    assert unique == [] and duplicates[0][1] == "2021-03_p1_o0"
+
+
+def test_detects_duplicates_across_issues_and_records_provenance():
+    index = DedupIndex()
+    _, dups, sigs = dedup_chunks([chunk("2021-03", 1, MASTHEAD)], index)
+    index.commit(sigs, dups)
+
+    unique, duplicates, sigs = dedup_chunks([chunk("2021-04", 1, MASTHEAD), chunk("2021-04", 2, ARTICLE)], index)
+    assert [c["chunk_id"] for c in unique] == ["2021-04_p2_o0"]
+    assert index.sources == {}
+    index.commit(sigs, duplicates)
+    assert index.sources_for(["2021-03_p1_o0"]) == {"2021-03_p1_o0": ["2021-04#p1"]}
+
+    # Re-running an issue is idempotent
+    _, duplicates, sigs = dedup_chunks([chunk("2021-04", 1, MASTHEAD)], index)
+    index.commit(sigs, duplicates)
+    assert index.sources == {"2021-03_p1_o0": ["2021-04#p1"]}
+
+
+def test_serialization_and_merge():
+    a, b = DedupIndex(), DedupIndex()
+    _, dups, sigs = dedup_chunks([chunk("2021-03", 1, MASTHEAD)], a)
+    a.commit(sigs, dups)
+    _, dups, sigs = dedup_chunks([chunk("2021-05", 2, ARTICLE)], b)
+    b.commit(sigs, dups)
+
+    restored = DedupIndex.from_dict(a.to_dict())
+    restored.merge(b)
+    assert set(restored.signatures) == {"2021-03_p1_o0", "2021-05_p2_o0"}
+    _, duplicates, _ = dedup_chunks([chunk("2021-06", 1, ARTICLE)], restored)
+    assert duplicates[0][1] == "2021-05_p2_o0"
+
+
+def test_concurrently_registered_canonicals_stay_canonical_on_reprocess():
+    index = DedupIndex()
+    issue_a = [chunk("2021-03", 1, MASTHEAD)]
+    issue_c = [chunk("2021-05", 1, MASTHEAD)]
+
+    # Both issues are deduped before either commits, so both copies become canonical
+    _, dups_a, sigs_a = dedup_chunks(issue_a, index)
+    _, dups_c, sigs_c = dedup_chunks(issue_c, index)
+    index.commit(sigs_a, dups_a)
+    index.commit(sigs_c, dups_c)
+    assert set(index.signatures) == {"2021-03_p1_o0", "2021-05_p1_o0"}
+
+    # The timer reprocesses every blob: neither copy may turn into a duplicate of the other
+    for issue in (issue_a, issue_c):
+        unique, duplicates, _ = dedup_chunks(issue, index)
+        assert [c["chunk_id"] for c in unique] == [issue[0]["chunk_id"]]
+        assert duplicates == []
+
+    # A genuinely new copy still matches one of them
+    _, duplicates, _ = dedup_chunks([chunk("2021-06", 1, MASTHEAD)], index)
+    assert duplicates[0][1] in {"2021-03_p1_o0", "2021-05_p1_o0"}